@@ -1,13 +1,84 @@
 """Summary
 """
+import os
 import re
 import math
+import mmap
 import logging
 
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
 plt.switch_backend('agg')
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# All log records of interest in one alternation; the name of the group
+# that closed last (``match.lastgroup``) tells which record was matched.
+LOG_RE = re.compile(rb"global_step (?P<step>\d+) : loss : (?P<loss>\S+)"
+                    rb"|Test after (?P<test_step>\d+) batches"
+                    rb"|Avg loss : (?P<test_loss>\S+)"
+                    # rb"|GAUC : (?P<gauc>\S+)"
+                    rb"|Merged gauc is (?P<gauc>\S+)")
+
+if njit is not None:
+    @njit(cache=True)
+    def smooth_array(arr, smooth_window_size):
+        # Single fused pass with a running window sum, no temporaries.
+        out = np.empty_like(arr)
+        s = 0.0
+        for i in range(arr.shape[0]):
+            s += arr[i]
+            if i >= smooth_window_size:
+                s -= arr[i - smooth_window_size]
+            out[i] = s / min(i + 1, smooth_window_size)
+        return out
+else:
+    smooth_array = None
+
+class ArrayBuffer(object):
+    """Append-only numpy array that doubles its capacity when full.
+
+    Attributes:
+        data (np.ndarray): Backing storage, valid up to ``size``.
+        size (int): Number of appended values.
+    """
+    def __init__(self, dtype, capacity=1024):
+        """Summary
+
+        Args:
+            dtype (np.dtype): Element type of the buffer.
+            capacity (int, optional): Initial number of slots.
+        """
+        self.data = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def append(self, value):
+        if self.size == self.data.shape[0]:
+            self.data = np.concatenate((self.data, np.empty_like(self.data)))
+        self.data[self.size] = value
+        self.size += 1
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self.data.dtype)
+        size = self.size + values.shape[0]
+        if size > self.data.shape[0]:
+            capacity = self.data.shape[0]
+            while capacity < size:
+                capacity *= 2
+            data = np.empty(capacity, dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:size] = values
+        self.size = size
+
+    def array(self):
+        return self.data[:self.size]
+
 class LogParser(object):
     """Summary
 
@@ -15,11 +86,11 @@ class LogParser(object):
         cparser (TYPE): Description
         has_test (bool): Description
         legend (str): Description
-        test_gauc_arr (list): Description
-        test_iter_arr (list): Description
-        test_loss_arr (list): Description
-        train_iter_arr (list): Description
-        train_loss_arr (list): Description
+        test_gauc_arr (np.ndarray): Description
+        test_iter_arr (np.ndarray): Description
+        test_loss_arr (np.ndarray): Description
+        train_iter_arr (np.ndarray): Description
+        train_loss_arr (np.ndarray): Description
     """
     def __init__(self, cparser):
         """Summary
@@ -39,18 +110,27 @@ class LogParser(object):
         self.test_loss_arr = []
         self.test_gauc_arr = []
 
+        # Parse results are collected here and exposed as *_arr views. Plotted
+        # values are float32; the extra precision is invisible on screen.
+        self.train_iter_buf = ArrayBuffer(np.int64)
+        self.train_loss_buf = ArrayBuffer(np.float32)
+        self.test_iter_buf = ArrayBuffer(np.int64)
+        self.test_loss_buf = ArrayBuffer(np.float32)
+        self.test_gauc_buf = ArrayBuffer(np.float32)
+
 
     def smooth_list(self, list_in, smooth_window_size):
-        list_out = []
-        for i in xrange(len(list_in)):
-            i_start = max(0, i - smooth_window_size + 1)
-            i_end = min(len(list_in), i + 1)
-            s = 0.0
-            for j in xrange(i_start, i_end):
-                 s += list_in[j]
-
-            s /= (i_end - i_start)
-            list_out.append(s)
+        # Trailing moving average in O(N): each window sum is the difference
+        # of two cumulative sums; the first windows are shorter.
+        arr = np.asarray(list_in, dtype=np.float64)
+        if arr.size == 0:
+            return arr
+        if smooth_array is not None:
+            return smooth_array(arr, smooth_window_size)
+        csum = np.cumsum(arr)
+        list_out = np.empty_like(csum)
+        list_out[:smooth_window_size] = csum[:smooth_window_size] / np.arange(1, min(smooth_window_size, arr.size) + 1)
+        list_out[smooth_window_size:] = (csum[smooth_window_size:] - csum[:-smooth_window_size]) / smooth_window_size
         return list_out
 
 
@@ -62,50 +142,69 @@ class LogParser(object):
             legend (TYPE): Description
 
         Returns:
-            TYPE: Description
+            LogParser: This parser, so it can be built and parsed in one call.
         """
         self.legend = legend
 
-        index = 0
-        loss_sum = 0.0
-
         cur_itr = 0
 
-
-
-        with open(filename, 'r') as fin:
-            line = fin.readline()
-            while line:
-                result1 = re.findall(r"global_step (\d+) : loss : (.+?)\n$", line)
-                result2 = re.findall(r"Test after (\d+) batches", line)
-                result3 = re.findall(r"Avg loss : (.+?)\n$", line)
-                # result4 = re.findall(r"GAUC : (.+?)\n$", line)
-                result4 = re.findall(r"Merged gauc is (.+?)\n$", line)
-
-                if result1:
-                    index = int(result1[0][0])
-                    loss_sum += float(result1[0][1])
-
-                    if index % self.cparser.train_loss_avg_window == 0:
-                        if max_batch_num is None or index <= max_batch_num:
-                            self.train_iter_arr.append(index)
-                            self.train_loss_arr.append(loss_sum / self.cparser.train_loss_avg_window)
-                        loss_sum = 0.0
-
-                elif result2:
-                    cur_itr = int(result2[0])
-                    if max_batch_num is None or cur_itr <= max_batch_num:
-                        self.test_iter_arr.append(int(result2[0]))
-                elif result3:
-                    if max_batch_num is None or cur_itr <= max_batch_num: 
-                        self.test_loss_arr.append(float(result3[0])) 
-                elif result4:
-                    if max_batch_num is None or cur_itr <= max_batch_num:
-                        self.test_gauc_arr.append(float(result4[0]))
-                else:
-                    pass
-
-                line = fin.readline()
+        # Raw train records; they are averaged per window after the scan. Plain
+        # lists append faster per record than ArrayBuffer and are converted once.
+        step_list = []
+        step_loss_list = []
+
+        # Bind hot attributes once instead of resolving them per record.
+        avg_window = self.cparser.train_loss_avg_window
+        step_append = step_list.append
+        step_loss_append = step_loss_list.append
+        test_iter_append = self.test_iter_buf.append
+        test_loss_append = self.test_loss_buf.append
+        test_gauc_append = self.test_gauc_buf.append
+
+        with open(filename, 'rb') as fin:
+            if os.fstat(fin.fileno()).st_size > 0:
+                with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    for m in LOG_RE.finditer(mm):
+                        kind = m.lastgroup
+
+                        if kind == 'loss':
+                            step_append(int(m.group('step')))
+                            step_loss_append(float(m.group('loss')))
+
+                        elif kind == 'test_step':
+                            cur_itr = int(m.group('test_step'))
+                            if max_batch_num is None or cur_itr <= max_batch_num:
+                                test_iter_append(cur_itr)
+                        elif kind == 'test_loss':
+                            if max_batch_num is None or cur_itr <= max_batch_num:
+                                test_loss_append(float(m.group('test_loss')))
+                        elif kind == 'gauc':
+                            if max_batch_num is None or cur_itr <= max_batch_num:
+                                test_gauc_append(float(m.group('gauc')))
+
+        # A window closes at every step that is a multiple of avg_window; its
+        # loss is the sum of the records since the previous close divided by
+        # avg_window. Records after the last close are dropped.
+        steps = np.array(step_list, dtype=np.int64)
+        ends = np.flatnonzero(steps % avg_window == 0)
+        window_iter = steps[ends]
+        window_loss = np.diff(np.cumsum(np.array(step_loss_list, dtype=np.float64))[ends], prepend=0.0) / avg_window
+        if max_batch_num is not None:
+            keep = window_iter <= max_batch_num
+            window_iter = window_iter[keep]
+            window_loss = window_loss[keep]
+        self.train_iter_buf.extend(window_iter)
+        self.train_loss_buf.extend(window_loss)
+
+        self.train_iter_arr = self.train_iter_buf.array()
+        self.train_loss_arr = self.train_loss_buf.array()
+        # Test series are cut to a common length so every panel's x and y
+        # line up; an evaluation whose results were never logged (e.g. an
+        # interrupted run) is dropped here once instead of on every plot.
+        test_num = min(self.test_iter_buf.size, self.test_loss_buf.size, self.test_gauc_buf.size)
+        self.test_iter_arr = self.test_iter_buf.array()[:test_num]
+        self.test_loss_arr = self.test_loss_buf.array()[:test_num]
+        self.test_gauc_arr = self.test_gauc_buf.array()[:test_num]
 
         #print(self.test_iter_arr)
         #print(self.test_loss_arr)
@@ -117,7 +216,7 @@ class LogParser(object):
 
 
         if self.avg_window_size > 1:
-            self.test_loss_arr = self.smooth_list(self.test_loss_arr, self.avg_window_size)
+            self.test_loss_arr = self.smooth_list(self.test_loss_arr, self.avg_window_size).astype(np.float32)
             #self.test_gauc_arr = self.smooth_list(self.test_gauc_arr, self.avg_window_size)
             
 
@@ -126,6 +225,8 @@ class LogParser(object):
         # print(self.test_loss_arr)
         # print(self.test_gauc_arr)
 
+        return self
+
 class PlotHandler(object):
     """Summary
 
@@ -140,7 +241,7 @@ class PlotHandler(object):
         """
         self.cparser = cparser
 
-    def draw(self, lparser_list, filename, mode='3column'):
+    def draw(self, lparser_list, filename, mode='3column', fig=None):
         """Summary
 
         Returns:
@@ -150,43 +251,63 @@ class PlotHandler(object):
             lparser_list (TYPE): Description
             filename (TYPE): Description
             mode (str, optional): Description
+            fig (Figure, optional): Figure to draw into, see plot_3column.
         """
         if mode == '3column':
-            self.plot_3column(lparser_list, filename)
+            self.plot_3column(lparser_list, filename, fig=fig)
             logging.info("Result plot has been saved to %s.", filename)
 
     @staticmethod
-    def plot_single(parser, axis, draw_type='Train Loss', loc='upper right'):
+    def get_series(parser, draw_type):
         """Summary
 
         Args:
-            parser (TYPE): Description
-            axis (TYPE): Description
-            draw_type (str, optional): Description
-            loc (str, optional): Description
+            parser (LogParser): Parsed log to take the curve from.
+            draw_type (str): Panel the curve is drawn on.
 
         Returns:
-            TYPE: Description
+            tuple: x values, y values and legend label of the curve.
         """
         if draw_type == 'Train Loss':
-            if(len(parser.train_iter_arr) > len(parser.train_loss_arr)):
-                parser.train_iter_arr = parser.train_iter_arr[:-1]
-            axis.plot(parser.train_iter_arr, parser.train_loss_arr,
-                      linewidth=0.5, label=parser.legend)
+            return parser.train_iter_arr, parser.train_loss_arr, parser.legend
         elif draw_type == 'Test Loss':
-            if(len(parser.test_iter_arr) > len(parser.test_loss_arr)):
-                parser.test_iter_arr = parser.test_iter_arr[:-1]
-            axis.plot(parser.test_iter_arr, parser.test_loss_arr,
-                      linewidth=0.5, label=parser.legend)
+            return parser.test_iter_arr, parser.test_loss_arr, parser.legend
         elif draw_type == 'Test GAUC':
-            if(len(parser.test_iter_arr) > len(parser.test_gauc_arr)):
-                parser.test_iter_arr = parser.test_iter_arr[:-1]
-            axis.plot(parser.test_iter_arr, parser.test_gauc_arr,
-                      linewidth=0.5, label=parser.legend)
+            return parser.test_iter_arr, parser.test_gauc_arr, parser.legend
         else:
             print("Unknown draw type %s." % draw_type)
             exit(1)
 
+    @staticmethod
+    def plot_batch(parser_list, axis, draw_type='Train Loss', loc='upper right'):
+        """Draws the curves of all parsers on one axis as a single LineCollection.
+
+        Args:
+            parser_list (list): Parsed logs, one curve each.
+            axis (TYPE): Description
+            draw_type (str, optional): Description
+            loc (str, optional): Description
+        """
+        # Train points here are already window averages, so curves stay short and
+        # one collection per panel is cheap. Agg does not simplify collections;
+        # draw_torch.py plots its per-batch curves as Line2D for that reason.
+        colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+        segments = []
+        handles = []
+        for i, parser in enumerate(parser_list):
+            x, y, label = PlotHandler.get_series(parser, draw_type)
+            color = colors[i % len(colors)]
+            segments.append(np.column_stack((x, y)))
+            # Proxy artist so the legend still has one entry per curve.
+            handles.append(Line2D([], [], color=color, linewidth=0.5, label=label))
+
+        # Panels without curves (e.g. no parser has test records) get no
+        # collection and no empty legend box.
+        if handles:
+            axis.add_collection(LineCollection(segments, colors=[h.get_color() for h in handles],
+                                               linewidths=0.5))
+            axis.autoscale_view()
+
         axis.grid(True)
 
         ttl = axis.set_title(draw_type, fontsize=18, fontweight='bold')
@@ -198,44 +319,57 @@ class PlotHandler(object):
         else:
             axis.set_ylabel('Loss', fontsize=12, labelpad=12)
 
-        axis.legend(loc=loc, fontsize=12)
+        if handles:
+            axis.legend(handles=handles, loc=loc, fontsize=12)
 
-    def plot_3column(self, lparser_list, filename):
+    def plot_3column(self, lparser_list, filename, fig=None):
         """Summary
 
         Args:
             lparser_list (TYPE): Description
             filename (TYPE): Description
+            fig (Figure, optional): Figure to reuse across calls; it is cleared
+                first and left open. Without it a new figure is created and
+                closed once saved, so repeated draws do not pile up in pyplot.
 
         Returns:
             TYPE: Description
         """
-        fig = plt.figure(figsize=(19, 5))
-        fig.subplots_adjust(wspace=0.3)
-
-        # Plot train loss
-        axis = fig.add_subplot(131)
-        for parser in lparser_list:
-            self.plot_single(parser, axis, draw_type='Train Loss')
-
-        axis = fig.add_subplot(132)
-        for parser in lparser_list:
-            if parser.has_test:
-                self.plot_single(parser, axis, draw_type='Test Loss')
-
-        axis = fig.add_subplot(133)
-        max_gauc = 0.0
-        for parser in lparser_list:
-            if parser.has_test:
-                max_gauc = max([max(parser.test_gauc_arr), max_gauc])
-                self.plot_single(parser, axis, draw_type='Test GAUC', loc='lower right')
-
-        if max_gauc > 0.0:
-            max_gauc = math.ceil(max_gauc * 100) / 100
-            axis.set_yticks(np.linspace(max_gauc - 0.02, max_gauc, 21), minor=True)
-            axis.grid(which='minor', alpha=1.0)
-
-        plt.savefig(filename, dpi=300, bbox_inches='tight')
+        own_fig = fig is None
+        if own_fig:
+            fig = plt.figure(figsize=(19, 5))
+        else:
+            fig.clear()
+            fig.set_size_inches((19, 5))
+
+        try:
+            test_parser_list = [parser for parser in lparser_list if parser.has_test]
+
+            # Plot train loss
+            axis = fig.add_subplot(131)
+            self.plot_batch(lparser_list, axis, draw_type='Train Loss')
+
+            axis = fig.add_subplot(132)
+            self.plot_batch(test_parser_list, axis, draw_type='Test Loss')
+
+            axis = fig.add_subplot(133)
+            max_gauc = 0.0
+            for parser in test_parser_list:
+                max_gauc = max(max_gauc, float(parser.test_gauc_arr.max()))
+            self.plot_batch(test_parser_list, axis, draw_type='Test GAUC', loc='lower right')
+
+            if max_gauc > 0.0:
+                max_gauc = math.ceil(max_gauc * 100) / 100
+                axis.set_yticks(np.linspace(max_gauc - 0.02, max_gauc, 21), minor=True)
+                axis.grid(which='minor', alpha=1.0)
+
+            # Lay out once up front instead of bbox_inches='tight', which renders
+            # the whole figure a second time just to measure its bounds.
+            fig.tight_layout(w_pad=3.0)
+            fig.savefig(filename, dpi=getattr(self.cparser, 'plot_dpi', 300))
+        finally:
+            if own_fig:
+                plt.close(fig)
 
 if __name__ == '__main__':
     class CParser(object):
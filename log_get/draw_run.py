@@ -1,3 +1,5 @@
+from concurrent.futures import ProcessPoolExecutor
+
 from draw_torch import LogParser, PlotHandler
 
 
@@ -13,6 +15,13 @@ class CParser(object):
         self.train_loss_avg_window = 5000
 
 
+def parse_log(log):
+    """Parses one (filename, legend) pair; runs in a worker process.
+    """
+    filename, legend = log
+    return LogParser(CParser()).parselog(filename, legend)
+
+
 
 #lparser9 = LogParser(CParser())
 #lparser9.parselog("/home/keyu.cky/workspace/xdl_10_18407_1500518354/log/py.log", "Baseline")
@@ -24,26 +33,21 @@ class CParser(object):
 #lparser11 = LogParser(CParser())
 #lparser11.parselog("/home/keyu.cky/workspace/xdl_18_27091_1500891896/log/py.log", "Baseline_&ad_doc2vec_id_image")
 
-lparser1 = LogParser(CParser())
-lparser1.parselog("log.deep.txt", "deep net")
-
-lparser2 = LogParser(CParser())
-lparser2.parselog("log.wide.txt", "wide net")
-
-lparser3 = LogParser(CParser())
-lparser3.parselog("log.deep.wide.txt", "deep&wide net")
-#lparser3 = LogParser(CParser())
-lparser4 = LogParser(CParser())
-lparser4.parselog("log.deep.fm.txt", "deep fm net")
-#lparser3.parselog("log.deep.wide.txt", "wide net")
+logs = [
+    ("log.deep.txt", "deep net"),
+    ("log.wide.txt", "wide net"),
+    ("log.deep.wide.txt", "deep&wide net"),
+    ("log.deep.fm.txt", "deep fm net"),
+]
+#("log.deep.wide.txt", "wide net")
 #lparser12 = LogParser(CParser())
 #lparser12.parselog("/home/keyu.cky/workspace/xdl_23_1492_1503589492/log/py.log", "ad_user_paper_perfect_st2")
 
 
-phandler = PlotHandler(None)
-phandler.draw([lparser1, lparser2, lparser3, lparser4], 'paper_graph_banner_paper.png')
-    
-    
+if __name__ == '__main__':
+    # The logs are independent, so parse them in parallel processes.
+    with ProcessPoolExecutor() as executor:
+        lparser_list = list(executor.map(parse_log, logs))
 
-    
-    
+    phandler = PlotHandler(None)
+    phandler.draw(lparser_list, 'paper_graph_banner_paper.png')
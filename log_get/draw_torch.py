@@ -1,12 +1,93 @@
 """Summary
 """
+import os
 import re
 import math
+import mmap
 import logging
 
 import numpy as np
 import matplotlib.pyplot as plt
 plt.switch_backend('agg')
+# Every batch is a train point, so curves get very long; let Agg drop
+# vertices closer than a pixel and rasterize long paths in chunks.
+plt.rcParams.update({'path.simplify': True,
+                     'path.simplify_threshold': 1.0,
+                     'agg.path.chunksize': 10000})
+
+# Train records make up the bulk of a log and are read in one findall pass
+# into a TRAIN_DTYPE array; the few evaluation records go through EVAL_RE.
+TRAIN_RE = re.compile(rb"epoch:(\d+)\tbatch_idx:(\d+)\ttotal_batch:(\d+)"
+                      rb"\tbatch_time:\S+\tdata_time:\S+\tloss:(\S+)\tID_auc:(\S+)")
+TRAIN_DTYPE = np.dtype([('epoch', np.int64), ('batch_idx', np.int64), ('total_batch', np.int64),
+                        ('loss', np.float32), ('auc', np.float32)])
+
+# The name of the group that closed last (``match.lastgroup``) tells which
+# evaluation record was matched.
+EVAL_RE = re.compile(rb"valid on epoch:\d+\tbatch_idx:\d+\ttotal_batch:\d+"
+                     rb"\tbatch_time:\S+\tdata_time:.+?ID_auc:(?P<valid_auc>\S+)"
+                     rb"|average loss:(?P<valid_loss>\S+) on valid dataset"
+                     rb"|Merged gauc is (?P<gauc>\S+)")
+
+def train_iter_before(buf, end):
+    """Summary
+
+    Args:
+        buf (mmap.mmap): Mapped log.
+        end (int): Offset to search backwards from.
+
+    Returns:
+        float: Iteration of the last train record before ``end``, 0 if none.
+    """
+    while True:
+        # Only train records carry a tab-prefixed loss field.
+        pos = buf.rfind(b"\tloss:", 0, end)
+        if pos < 0:
+            return 0
+        start = buf.rfind(b"\n", 0, pos) + 1
+        m = TRAIN_RE.search(buf, start, end)
+        if m:
+            return (float(m.group(1)) - 1) * float(m.group(3)) + float(m.group(2))
+        end = start
+
+class ArrayBuffer(object):
+    """Append-only numpy array that doubles its capacity when full.
+
+    Attributes:
+        data (np.ndarray): Backing storage, valid up to ``size``.
+        size (int): Number of appended values.
+    """
+    def __init__(self, dtype, capacity=1024):
+        """Summary
+
+        Args:
+            dtype (np.dtype): Element type of the buffer.
+            capacity (int, optional): Initial number of slots.
+        """
+        self.data = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def append(self, value):
+        if self.size == self.data.shape[0]:
+            self.data = np.concatenate((self.data, np.empty_like(self.data)))
+        self.data[self.size] = value
+        self.size += 1
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self.data.dtype)
+        size = self.size + values.shape[0]
+        if size > self.data.shape[0]:
+            capacity = self.data.shape[0]
+            while capacity < size:
+                capacity *= 2
+            data = np.empty(capacity, dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:size] = values
+        self.size = size
+
+    def array(self):
+        return self.data[:self.size]
 
 class LogParser(object):
     """Summary
@@ -15,11 +96,11 @@ class LogParser(object):
         cparser (TYPE): Description
         has_test (bool): Description
         legend (str): Description
-        test_gauc_arr (list): Description
-        test_iter_arr (list): Description
-        test_loss_arr (list): Description
-        train_iter_arr (list): Description
-        train_loss_arr (list): Description
+        test_gauc_arr (np.ndarray): Description
+        test_iter_arr (np.ndarray): Description
+        test_loss_arr (np.ndarray): Description
+        train_iter_arr (np.ndarray): Description
+        train_loss_arr (np.ndarray): Description
     """
     def __init__(self, cparser):
         """Summary
@@ -41,18 +122,27 @@ class LogParser(object):
         self.test_gauc_arr = []
         self.test_auc_arr = []
 
+        # Parse results are collected here and exposed as *_arr views. Plotted
+        # values are float32; the extra precision is invisible on screen.
+        self.train_iter_buf = ArrayBuffer(np.float64)
+        self.train_loss_buf = ArrayBuffer(np.float32)
+        self.train_auc_buf = ArrayBuffer(np.float32)
+        self.test_iter_buf = ArrayBuffer(np.float64)
+        self.test_loss_buf = ArrayBuffer(np.float32)
+        self.test_gauc_buf = ArrayBuffer(np.float32)
+        self.test_auc_buf = ArrayBuffer(np.float32)
+
 
     def smooth_list(self, list_in, smooth_window_size):
-        list_out = []
-        for i in xrange(len(list_in)):
-            i_start = max(0, i - smooth_window_size + 1)
-            i_end = min(len(list_in), i + 1)
-            s = 0.0
-            for j in xrange(i_start, i_end):
-                 s += list_in[j]
-
-            s /= (i_end - i_start)
-            list_out.append(s)
+        # Trailing moving average in O(N): each window sum is the difference
+        # of two cumulative sums; the first windows are shorter.
+        arr = np.asarray(list_in, dtype=np.float64)
+        if arr.size == 0:
+            return arr
+        csum = np.cumsum(arr)
+        list_out = np.empty_like(csum)
+        list_out[:smooth_window_size] = csum[:smooth_window_size] / np.arange(1, min(smooth_window_size, arr.size) + 1)
+        list_out[smooth_window_size:] = (csum[smooth_window_size:] - csum[:-smooth_window_size]) / smooth_window_size
         return list_out
 
 
@@ -64,63 +154,67 @@ class LogParser(object):
             legend (TYPE): Description
 
         Returns:
-            TYPE: Description
+            LogParser: This parser, so it can be built and parsed in one call.
         """
         self.legend = legend
 
-        index = 0
-        loss_sum = 0.0
-        auc_sum = 0.0
         cur_itr = 0
 
-
-        re_cur_itr=0
-        with open(filename, 'r') as fin:
-            line = fin.readline()
-            while line:
-                #re_cur_itr+=1
-                #result1 = re.findall(r"global_step (\d+) : loss : (.+?)\n$", line)
-                result1 = re.findall(r"epoch:(\d+)	batch_idx:(\d+)	total_batch:(\d+)	batch_time:(.+?)	data_time:(.+?)	loss:(.+?)	ID_auc:(.+?)	", line)
-                #print("result1:", result1)
-                #result2 = re.findall(r"Test after (\d+) batches", line)
-                result2 = re.findall(r"valid on epoch:(\d+)	batch_idx:(\d+)	total_batch:(\d+)	batch_time:(.+?)	data_time:(.+?)ID_auc:(.+?)	", line)
-                result3 = re.findall(r"average loss:(.+?) on valid dataset", line)
-                # result4 = re.findall(r"GAUC : (.+?)\n$", line)
-                result4 = re.findall(r"Merged gauc is (.+?)\n$", line)
-                
-                if result1:
-                    re_cur_itr = (float(result1[0][0]) - 1) * float(result1[0][2]) + float(result1[0][1])
-                    index = re_cur_itr
-                    loss_sum = float(result1[0][5])
-                    auc_sum =float(result1[0][6])
-                    #print("result1:", result1)
+        # Bind hot attributes once instead of resolving them per record.
+        test_iter_append = self.test_iter_buf.append
+        test_loss_append = self.test_loss_buf.append
+        test_gauc_append = self.test_gauc_buf.append
+        test_auc_append = self.test_auc_buf.append
+
+        with open(filename, 'rb') as fin:
+            if os.fstat(fin.fileno()).st_size > 0:
+                with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    # findall scans the mapping in place; np.fromregex would
+                    # first copy the whole file out with mm.read().
+                    train = np.array(TRAIN_RE.findall(mm), dtype=TRAIN_DTYPE)
+                    train_iter = (train['epoch'] - 1.0) * train['total_batch'] + train['batch_idx']
                     #if index % self.cparser.train_loss_avg_window == 0:
-                    if max_batch_num is None or index <= max_batch_num:
-                        self.train_iter_arr.append(index)
-                        self.train_loss_arr.append(loss_sum)
-                        self.train_auc_arr.append(auc_sum)
-                        #print("flag1")
-                        #loss_sum = 0.0
-                        #auc_sum = 0.0
-
-                elif result2:
-                    print("result2:", result2)
-                    cur_itr = re_cur_itr
-
-                    if max_batch_num is None or cur_itr <= max_batch_num:
-                        self.test_iter_arr.append(cur_itr)
-                        self.test_auc_arr.append(float(result2[0][5]))
-                elif result3:
-                    print("result3:", result3)
-                    if max_batch_num is None or cur_itr <= max_batch_num: 
-                        self.test_loss_arr.append(float(result3[0])) 
-                elif result4:
-                    if max_batch_num is None or cur_itr <= max_batch_num:
-                        self.test_gauc_arr.append(float(result4[0]))
-                else:
-                    pass
-
-                line = fin.readline()
+                    if max_batch_num is None:
+                        self.train_iter_buf.extend(train_iter)
+                        self.train_loss_buf.extend(train['loss'])
+                        self.train_auc_buf.extend(train['auc'])
+                    else:
+                        keep = train_iter <= max_batch_num
+                        self.train_iter_buf.extend(train_iter[keep])
+                        self.train_loss_buf.extend(train['loss'][keep])
+                        self.train_auc_buf.extend(train['auc'][keep])
+
+                    for m in EVAL_RE.finditer(mm):
+                        kind = m.lastgroup
+
+                        if kind == 'valid_auc':
+                            logging.debug("result2: %s", m.group())
+                            cur_itr = train_iter_before(mm, m.start())
+
+                            if max_batch_num is None or cur_itr <= max_batch_num:
+                                test_iter_append(cur_itr)
+                                test_auc_append(float(m.group('valid_auc')))
+                        elif kind == 'valid_loss':
+                            logging.debug("result3: %s", m.group('valid_loss'))
+                            if max_batch_num is None or cur_itr <= max_batch_num:
+                                test_loss_append(float(m.group('valid_loss')))
+                        elif kind == 'gauc':
+                            if max_batch_num is None or cur_itr <= max_batch_num:
+                                test_gauc_append(float(m.group('gauc')))
+
+        self.train_iter_arr = self.train_iter_buf.array()
+        self.train_loss_arr = self.train_loss_buf.array()
+        self.train_auc_arr = self.train_auc_buf.array()
+        # The plotted test series (iter, loss, auc) are cut to a common length
+        # so every panel's x and y line up; an evaluation whose results were
+        # never logged (e.g. an interrupted run) is dropped here once instead
+        # of on every plot. test_gauc is left as-is: it is never plotted and
+        # many runs do not log it, which would otherwise cut everything to 0.
+        test_num = min(self.test_iter_buf.size, self.test_loss_buf.size, self.test_auc_buf.size)
+        self.test_iter_arr = self.test_iter_buf.array()[:test_num]
+        self.test_loss_arr = self.test_loss_buf.array()[:test_num]
+        self.test_gauc_arr = self.test_gauc_buf.array()
+        self.test_auc_arr = self.test_auc_buf.array()[:test_num]
 
         #print(self.test_iter_arr)
         #print(self.test_loss_arr)
@@ -141,6 +235,8 @@ class LogParser(object):
         # print(self.test_loss_arr)
         # print(self.test_gauc_arr)
 
+        return self
+
 class PlotHandler(object):
     """Summary
 
@@ -155,7 +251,7 @@ class PlotHandler(object):
         """
         self.cparser = cparser
 
-    def draw(self, lparser_list, filename, mode='3column'):
+    def draw(self, lparser_list, filename, mode='3column', fig=None):
         """Summary
 
         Returns:
@@ -165,59 +261,53 @@ class PlotHandler(object):
             lparser_list (TYPE): Description
             filename (TYPE): Description
             mode (str, optional): Description
+            fig (Figure, optional): Figure to draw into, see plot_3column.
         """
         if mode == '3column':
-            self.plot_3column(lparser_list, filename)
+            self.plot_3column(lparser_list, filename, fig=fig)
             logging.info("Result plot has been saved to %s.", filename)
 
     @staticmethod
-    def plot_single(parser, axis, draw_type='Train Loss', loc='upper right'):
+    def get_series(parser, draw_type):
         """Summary
 
         Args:
-            parser (TYPE): Description
-            axis (TYPE): Description
-            draw_type (str, optional): Description
-            loc (str, optional): Description
+            parser (LogParser): Parsed log to take the curve from.
+            draw_type (str): Panel the curve is drawn on.
 
         Returns:
-            TYPE: Description
+            tuple: x values, y values and legend label of the curve.
         """
         if draw_type == 'Train Loss':
-            if(len(parser.train_iter_arr) > len(parser.train_loss_arr)):
-                parser.train_iter_arr = parser.train_iter_arr[:-1]
-            print("parser.train_loss_arr:", parser.train_loss_arr)
-            axis.plot(parser.train_iter_arr, parser.train_loss_arr,
-                      linewidth=1.0, label=parser.legend)
+            return parser.train_iter_arr, parser.train_loss_arr, parser.legend
         elif draw_type == 'Test Loss':
-            if(len(parser.test_iter_arr) > len(parser.test_loss_arr)):
-                parser.test_iter_arr = parser.test_iter_arr[:-1]
-            print("len(parser.test_iter_arr):", len(parser.test_iter_arr))
-            print("len(parser.test_loss_arr):", len(parser.test_loss_arr))
-            print("parser.test_loss_arr:", parser.test_loss_arr)
-            axis.plot(parser.test_iter_arr, parser.test_loss_arr,
-                      linewidth=1.0, label=parser.legend)
+            return parser.test_iter_arr, parser.test_loss_arr, parser.legend
         elif draw_type == 'Train AUC':
-            if(len(parser.test_iter_arr) > len(parser.test_auc_arr)):
-                parser.test_iter_arr = parser.test_iter_arr[:-1]
-            print("len(parser.test_iter_arr):", len(parser.train_iter_arr))
-            print("len(parser.test_auc_arr):", len(parser.train_auc_arr))
-            print("parser.test_auc_arr:", parser.test_auc_arr)
-            axis.plot(parser.train_iter_arr, parser.train_auc_arr,
-                      linewidth=1.0, label=parser.legend)
+            return parser.train_iter_arr, parser.train_auc_arr, parser.legend
         elif draw_type == 'Test AUC':
-            if(len(parser.test_iter_arr) > len(parser.test_auc_arr)):
-                parser.test_iter_arr = parser.test_iter_arr[:-1]
-            print("len(parser.test_iter_arr):", len(parser.test_iter_arr))
-            print("len(parser.test_auc_arr):", len(parser.test_auc_arr))
-            print("parser.test_auc_arr:", parser.test_auc_arr)
-            max_auc=max(parser.test_auc_arr)
-            axis.plot(parser.test_iter_arr, parser.test_auc_arr,
-                      linewidth=1.0, label=parser.legend + "(max_auc:{0:.4f})".format(max_auc))
+            max_auc = float(parser.test_auc_arr.max())
+            return parser.test_iter_arr, parser.test_auc_arr, parser.legend + "(max_auc:{0:.4f})".format(max_auc)
         else:
             print("Unknown draw type %s." % draw_type)
             exit(1)
 
+    @staticmethod
+    def plot_batch(parser_list, axis, draw_type='Train Loss', loc='upper right'):
+        """Draws the curves of all parsers on one axis.
+
+        Args:
+            parser_list (list): Parsed logs, one curve each.
+            axis (TYPE): Description
+            draw_type (str, optional): Description
+            loc (str, optional): Description
+        """
+        # One Line2D per curve rather than a LineCollection: Agg only simplifies
+        # and chunks single paths, and per-batch train curves are very long.
+        for parser in parser_list:
+            x, y, label = PlotHandler.get_series(parser, draw_type)
+            logging.debug("%s %s: %d points", draw_type, label, len(y))
+            axis.plot(x, y, linewidth=1.0, label=label)
+
         axis.grid(True)
 
         ttl = axis.set_title(draw_type, fontsize=18, fontweight='bold')
@@ -229,48 +319,59 @@ class PlotHandler(object):
         else:
             axis.set_ylabel('Loss', fontsize=12, labelpad=12)
 
-        axis.legend(loc=loc, fontsize=12)
+        if parser_list:
+            axis.legend(loc=loc, fontsize=12)
 
-    def plot_3column(self, lparser_list, filename):
+    def plot_3column(self, lparser_list, filename, fig=None):
         """Summary
 
         Args:
             lparser_list (TYPE): Description
             filename (TYPE): Description
+            fig (Figure, optional): Figure to reuse across calls; it is cleared
+                first and left open. Without it a new figure is created and
+                closed once saved, so repeated draws do not pile up in pyplot.
 
         Returns:
             TYPE: Description
         """
-        fig = plt.figure(figsize=(15, 15))
-        fig.subplots_adjust(wspace=0.3)
-
-        # Plot train loss
-        axis = fig.add_subplot(221)
-        for parser in lparser_list:
-            self.plot_single(parser, axis, draw_type='Train Loss')
-
-        axis = fig.add_subplot(222)
-        for parser in lparser_list:
-            if parser.has_test:
-                self.plot_single(parser, axis, draw_type='Test Loss')
-
-        axis = fig.add_subplot(223)
-        for parser in lparser_list:
-            if parser.has_test:
-                self.plot_single(parser, axis, draw_type='Train AUC')
-        axis = fig.add_subplot(224)
-        max_gauc = 0.0
-        for parser in lparser_list:
-            if parser.has_test:
-                max_gauc = max([max(parser.test_auc_arr), max_gauc])
-                self.plot_single(parser, axis, draw_type='Test AUC', loc='lower right')
-
-        if max_gauc > 0.0:
-            #max_gauc = math.ceil(max_gauc * 100) / 100
-            #axis.set_yticks(np.linspace(max_gauc - 0.02, max_gauc, 21), minor=True)
-            axis.grid(which='minor', alpha=1.0)
-
-        plt.savefig(filename, dpi=300, bbox_inches='tight')
+        own_fig = fig is None
+        if own_fig:
+            fig = plt.figure(figsize=(15, 15))
+        else:
+            fig.clear()
+            fig.set_size_inches((15, 15))
+
+        try:
+            test_parser_list = [parser for parser in lparser_list if parser.has_test]
+
+            # Plot train loss
+            axis = fig.add_subplot(221)
+            self.plot_batch(lparser_list, axis, draw_type='Train Loss')
+
+            axis = fig.add_subplot(222)
+            self.plot_batch(test_parser_list, axis, draw_type='Test Loss')
+
+            axis = fig.add_subplot(223)
+            self.plot_batch(test_parser_list, axis, draw_type='Train AUC')
+            axis = fig.add_subplot(224)
+            max_gauc = 0.0
+            for parser in test_parser_list:
+                max_gauc = max(max_gauc, float(parser.test_auc_arr.max()))
+            self.plot_batch(test_parser_list, axis, draw_type='Test AUC', loc='lower right')
+
+            if max_gauc > 0.0:
+                #max_gauc = math.ceil(max_gauc * 100) / 100
+                #axis.set_yticks(np.linspace(max_gauc - 0.02, max_gauc, 21), minor=True)
+                axis.grid(which='minor', alpha=1.0)
+
+            # Lay out once up front instead of bbox_inches='tight', which renders
+            # the whole figure a second time just to measure its bounds.
+            fig.tight_layout(w_pad=3.0)
+            fig.savefig(filename, dpi=getattr(self.cparser, 'plot_dpi', 300))
+        finally:
+            if own_fig:
+                plt.close(fig)
 
 if __name__ == '__main__':
     class CParser(object):
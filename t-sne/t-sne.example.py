@@ -1,118 +1,111 @@
-from sklearn import (manifold, datasets, decomposition, ensemble, random_projection)
-from sklearn.manifold import TSNE
+from sklearn import manifold
 from sklearn.decomposition import PCA
 import numpy as np
+import hashlib
+import os
 import time
+from itertools import islice
 import matplotlib.pyplot as plt
 plt.switch_backend('agg')
-from matplotlib import offsetbox
-import string
+try:
+  # FFT-accelerated t-SNE (pip install fitsne); sklearn's Barnes-Hut otherwise.
+  from fitsne import FItSNE
+except ImportError:
+  FItSNE = None
+## Embedding settings; part of the cache key, so changing them recomputes.
+PCA_DIMS = 50
+PERPLEXITY = 30
+SEED = 0
 ## Loading and curating the data
-## Function to Scale and visualize the embedding vectors
-def plot_embedding(X, title=None):
-    x_min, x_max = np.min(X, 0), np.max(X, 0)
-    X = (X - x_min) / (x_max - x_min)
-    plt.figure()
-    ax = plt.subplot(111)
-    for i in range(X.shape[0]):
-        plt.text(X[i, 0], X[i, 1], str(digits.target[i]),
-                 color=plt.cm.Set1(y[i] / 10.),
-                 fontdict={'weight': 'bold', 'size': 9})
-    if hasattr(offsetbox, 'AnnotationBbox'):
-        ## only print thumbnails with matplotlib > 1.0
-        shown_images = np.array([[1., 1.]])  # just something big
-        for i in range(digits.data.shape[0]):
-            dist = np.sum((X[i] - shown_images) ** 2, 1)
-            if np.min(dist) < 4e-3:
-                ## don't show points that are too close
-                continue
-            shown_images = np.r_[shown_images, [X[i]]]
-            imagebox = offsetbox.AnnotationBbox(
-                offsetbox.OffsetImage(digits.images[i], cmap=plt.cm.gray_r),
-                X[i])
-            ax.add_artist(imagebox)
-    plt.xticks([]), plt.yticks([])
-    if title is not None:
-        plt.title(title)
+def load_vectors(file_name, step=1):
+  """Reads every step-th "template_id^Evec" line of file_name and parses all
+  the comma separated vectors with one np.fromstring call into a (rows, dim)
+  matrix; template ids are not kept."""
+  vec_strs = []
+  with open(file_name, "r") as fin:
+    for eachline in islice(fin, step - 1, None, step):
+      vec_strs.append(eachline.strip().split("\x05")[1])
+  if not vec_strs:
+    ## Nothing sampled (empty file or fewer than step lines); the width is
+    ## unknown, so embed() leaves this block out of the concatenation.
+    return np.empty((0, 0), dtype=np.float32)
+  dim = vec_strs[0].count(",") + 1
+  for i, vec_str in enumerate(vec_strs):
+    if vec_str.count(",") + 1 != dim:
+      raise ValueError("%s: sampled row %d has %d values, expected %d"
+                       % (file_name, i, vec_str.count(",") + 1, dim))
+  vecs = np.fromstring(",".join(vec_strs), sep=",", dtype=np.float32)
+  if vecs.size != len(vec_strs) * dim:
+    raise ValueError("%s: could not parse all vector values" % file_name)
+  return vecs.reshape(len(vec_strs), dim)
 
 
-fin = open("fund_mlr_n_newton_deep_qscore_vector.20180727.template","r")
-dic_data = {}
-dic_list=[]
-target_list=[]
-for eachline in fin:
-  each_field=eachline.strip().split("")
-  template_id = each_field[0]
-  vec_str = each_field[1]
-  vec_list = [string.atof(ele) for ele in vec_str.split(",")]
-  vec_array = np.array(vec_list)
-  distance= np.sqrt(np.sum(np.square(vec_array)))
-  dic_data.setdefault(template_id, vec_array)
-  dic_list.append(vec_array)
-  target_list.append(0)
-  #print("template_id", template_id)
-  #print("distance:", distance)
+def cache_key(input_files):
+  """blake2b over (path, mtime, size, step) of every input file plus the
+  t-SNE backend and embedding settings, so edited inputs, a newly installed
+  fitsne or changed parameters all miss the cache."""
+  h = hashlib.blake2b(digest_size=16)
+  backend = "fitsne" if FItSNE is not None else "sklearn"
+  h.update(repr((backend, PCA_DIMS, PERPLEXITY, SEED)).encode("utf-8"))
+  for file_name, step in input_files:
+    st = os.stat(file_name)
+    h.update(repr((os.path.abspath(file_name), st.st_mtime, st.st_size, step)).encode("utf-8"))
+  return h.hexdigest()
 
-#emb_output=np.array(dic_list)
-file_name=""
-i_cnt=0
-with open(file_name,"r") as fin:
-  for eachline in fin:
-    i_cnt+=1
-    if i_cnt % 300 != 0:
-      continue
-    each_field=eachline.strip().split("")
-    template_id = each_field[0]
-    vec_str = each_field[1]
-    vec_list = [string.atof(ele) for ele in vec_str.split(",")]
-    vec_array = np.array(vec_list)
-    distance= np.sqrt(np.sum(np.square(vec_array)))
-    dic_data.setdefault(template_id, vec_array)
-    dic_list.append(vec_array)
-    target_list.append(1)
-#emb_output=np.concate((emb_output, np.array()), axis=0);
-file_name=""
-i_cnt=0
-with open(file_name,"r") as fin:
-  for eachline in fin:
-    i_cnt+=1
-    if i_cnt % 300 != 0:
-      continue
-    each_field=eachline.strip().split("")
-    template_id = each_field[0]
-    vec_str = each_field[1]
-    vec_list = [string.atof(ele) for ele in vec_str.split(",")]
-    vec_array = np.array(vec_list)
-    distance= np.sqrt(np.sum(np.square(vec_array)))
-    dic_data.setdefault(template_id, vec_array)
-    dic_list.append(vec_array)
-    target_list.append(2)
-emb_output=np.array(dic_list)
-np_target=np.array(target_list)
-print(emb_output.shape)
-print(len(target_list))
-#exit()
-digits = datasets.load_digits(n_class=10)
-X = digits.data
-y = digits.target
-n_samples, n_features = X.shape
-n_neighbors = 30
-## Computing t-SNE
-print(X)
-print(X.shape)
-#exit()
-print("Computing t-SNE embedding")
-tsne = manifold.TSNE(n_components=2, init='pca', random_state=0)
-t0 = time.time()
-X_tsne = tsne.fit_transform(emb_output)
-X_pca = PCA().fit_transform(emb_output)
-#plot_embedding(X_tsne,
-#               "t-SNE embedding of the digits (time %.2fs)" %
-#               (time.time() - t0))
+
+def embed(input_files):
+  """Parses the input files and returns (X_tsne, X_pca, np_target)."""
+  dic_list=[]
+  target_list=[]
+  for target, (file_name, step) in enumerate(input_files):
+    vecs = load_vectors(file_name, step)
+    dic_list.append(vecs)
+    target_list.extend([target] * len(vecs))
+  emb_output=np.concatenate([vecs for vecs in dic_list if len(vecs)])
+  np_target=np.array(target_list)
+  print(emb_output.shape)
+  print(len(target_list))
+  #exit()
+  ## Computing t-SNE
+  print("Computing t-SNE embedding")
+  ## t-SNE affinities only need the leading directions, so reduce the input to
+  ## PCA_DIMS dims first; init='pca' only initialises the 2-D output.
+  if emb_output.shape[1] > PCA_DIMS:
+    emb50 = PCA(n_components=PCA_DIMS, svd_solver='randomized', random_state=SEED).fit_transform(emb_output)
+  else:
+    emb50 = emb_output
+  t0 = time.time()
+  if FItSNE is not None:
+    X_tsne = FItSNE(emb50.astype(np.float64), no_dims=2, perplexity=PERPLEXITY,
+                    nthreads=os.cpu_count() or 1, rand_seed=SEED)
+  else:
+    tsne = manifold.TSNE(n_components=2, perplexity=PERPLEXITY, init='pca',
+                         random_state=SEED, n_jobs=-1)
+    X_tsne = tsne.fit_transform(emb50)
+  print("t-SNE done in %.2fs" % (time.time() - t0))
+  X_pca = PCA(n_components=2, svd_solver='randomized', random_state=SEED).fit_transform(emb50)
+  return X_tsne, X_pca, np_target
+
+
+input_files = [
+    ("fund_mlr_n_newton_deep_qscore_vector.20180727.template", 1),
+    ("", 300),
+    ("", 300)]
+## t-SNE dominates the runtime, so reuse the embeddings of unchanged inputs.
+cache_file = os.path.join("cache", cache_key(input_files) + ".npz")
+if os.path.exists(cache_file):
+  print("Loading cached embeddings from %s" % cache_file)
+  cached = np.load(cache_file)
+  X_tsne, X_pca, np_target = cached["X_tsne"], cached["X_pca"], cached["np_target"]
+else:
+  X_tsne, X_pca, np_target = embed(input_files)
+  if not os.path.isdir("cache"):
+    os.makedirs("cache")
+  np.savez_compressed(cache_file, X_tsne=X_tsne, X_pca=X_pca, np_target=np_target)
 plt.figure(figsize=(10, 5))
 plt.subplot(121)
-plt.scatter(X_tsne[:, 0], X_tsne[:, 1], c=np_target,label="t-SNE")
+plt.scatter(X_tsne[:, 0], X_tsne[:, 1], c=np_target, s=2, rasterized=True, label="t-SNE")
 plt.subplot(122)
-plt.scatter(X_pca[:, 0], X_pca[:, 1], c=np_target,label="PCA")
-plt.savefig('t-sne.jpg')
+plt.scatter(X_pca[:, 0], X_pca[:, 1], c=np_target, s=2, rasterized=True, label="PCA")
+plt.savefig('t-sne.jpg', dpi=120)
 